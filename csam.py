@@ -1,9 +1,31 @@
 import numpy as np
+from functools import lru_cache
 from scipy.sparse import csr_matrix
+from hkg_ag import graph_version, tokenize
+from csam_kernel import accumulate, combine_scores
+from typing import NamedTuple
 import logging
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+try:
+    import simsimd
+except ImportError:
+    simsimd = None
+
+logger = logging.getLogger(__name__)
+
+# Layers past the layer_importance table share the last (1.0) entry of the padded table
+LAYER_TABLE_SIZE = 256
+# Reference matrices gathered over the query's features up to this many elements use SimSIMD
+SIMSIMD_MAX_ELEMENTS = 1 << 22
+
+class AttentionResult(NamedTuple):
+    """Attention scores as arrays aligned with the order of the HKG nodes passed to CSAM.attend."""
+    node_ids: np.ndarray
+    scores: np.ndarray
+
+    def as_dict(self):
+        """Returns a dictionary mapping node_id to the attention score."""
+        return dict(zip(self.node_ids.tolist(), self.scores.tolist()))
 
 class CSAM:
     def __init__(self, feature_dimension, layer_importance = [1, 1.2, 1.4, 1.6], keyword_importance = 0.2, edge_importance = 0.1, min_layer_edge_context = 2):
@@ -22,7 +44,35 @@ class CSAM:
         self.keyword_importance = keyword_importance
         self.edge_importance = edge_importance
         self.min_layer_edge_context = min_layer_edge_context
-        logging.info("CSAM initialized")
+        self._indexed_nodes = None
+        self._node_ids = np.empty(0, dtype=object)
+        self._active_positions = np.zeros(0, dtype=np.intp)
+        self._inactive_positions = np.zeros(0, dtype=np.intp)
+        self._layers = np.zeros(0, dtype=np.int64)
+        self._ref_counts = np.zeros(0, dtype=np.int64)
+        self._indexed_graph = None
+        self._indexed_version = None
+        self._vocabulary = {}
+        self._node_token_matrix = csr_matrix((0, 0), dtype=np.float32)
+        self._edge_token_matrix = csr_matrix((0, 0), dtype=np.float32)
+        self._ref_matrix = csr_matrix((0, feature_dimension), dtype=np.float32)
+        self._ref_to_node = np.zeros(0, dtype=np.intp)
+        self._scalar_signs = np.zeros(0)
+        self._scalar_to_node = np.zeros(0, dtype=np.intp)
+        # Repeated queries skip parsing; keyed on the query items and the feature dimension
+        self._parse_query_items = lru_cache(maxsize=64)(self._parse_query_items)
+        logger.info("CSAM initialized")
+
+    @property
+    def layer_importance(self):
+        return self._layer_importance
+
+    @layer_importance.setter
+    def layer_importance(self, layer_importance):
+        """Pads the layer multipliers with 1.0 so that scoring reads them without a bounds check."""
+        self._layer_importance = layer_importance
+        self._layer_table = np.ones(max(LAYER_TABLE_SIZE, len(layer_importance) + 1), dtype=np.float32)
+        self._layer_table[:len(layer_importance)] = layer_importance
 
     def attend(self, query_chunk, hkg_nodes, hkg_graph):
         """
@@ -31,96 +81,244 @@ class CSAM:
         Args:
             query_chunk (dict): A dictionary representing the sparse
                                        representation of the information.
-            hkg_nodes (list):  A list of tuples, where each tuple contains
-                                   (node_id, node_data) from HKG-AG.
+            hkg_nodes (list or tuple):  A sequence of tuples, such as HKG_AG.nodes_snapshot(), where each tuple contains
+                                   (node_id, node_data) from HKG-AG. The node arrays built from it
+                                   are reused while the same sequence and graph are passed in and the graph's
+                                   'version' attribute (bumped by every HKG_AG mutator) is unchanged. Changes made
+                                   any other way (editing the list, the node dicts or the graph directly) are not
+                                   detected, so pass a new list after making them.
             hkg_graph (networkx.MultiDiGraph): A graph object that contains the edges of the HKG_AG
+                                   Its is_a edges are indexed together with hkg_nodes.
         Returns:
-            dict: A dictionary mapping node_id to the attention score.
+            AttentionResult: The node ids (a read-only array shared between calls) and their float32
+                             attention scores, in the order of hkg_nodes.
         """
-        logging.info(f"Querying with: {query_chunk}")
+        logger.info("Querying with: %s", query_chunk)
         try:
-            sparse_query = self._dict_to_sparse(query_chunk)
+            query_indices, query_values, query_magnitude = self._parsed_query(query_chunk)
         except ValueError as e:
-            logging.error(f"Error in attend method: {e}")
-            return {}
-        attention_scores = {}
-
-        for node_id, node_data in hkg_nodes:
-             if node_data.get('sanm_references'):
-                total_similarity = 0
-                for sanm_ref in node_data['sanm_references']:
-                    sparse_mem = self._array_to_sparse(sparse_query.toarray().flatten() * sanm_ref)
-                    similarity = self._calculate_similarity(sparse_query, sparse_mem)
-                    total_similarity += similarity
-
-                if len(node_data['sanm_references']) > 0:
-                     average_similarity = total_similarity/len(node_data['sanm_references'])
+            logger.error("Error in attend method: %s", e)
+            return AttentionResult(np.empty(0, dtype=object), np.empty(0, dtype=np.float32))
+        if (hkg_nodes is not self._indexed_nodes or hkg_graph is not self._indexed_graph
+                or graph_version(hkg_graph) != self._indexed_version):
+            self._build_node_index(hkg_nodes, hkg_graph)
+        active_count = len(self._active_positions)
+
+        node_similarity = self._similarity_totals(query_indices, query_values, query_magnitude)
+        # A scalar reference scales the whole query, so its similarity is its sign
+        if query_magnitude > 0:
+            node_similarity += np.bincount(self._scalar_to_node, weights=self._scalar_signs, minlength=active_count)
+
+        # Keyword and edge scores count query keywords among the node's and its is_a targets' tokens
+        query_keywords = {str(keyword).lower() for keyword in query_chunk}
+        keyword_mask = np.zeros(len(self._vocabulary), dtype=np.float32)
+        keyword_mask[[self._vocabulary[keyword] for keyword in query_keywords if keyword in self._vocabulary]] = 1
+        keyword_counts = self._node_token_matrix @ keyword_mask
+        edge_counts = self._edge_token_matrix @ keyword_mask
+
+        scores = np.empty(active_count)
+        combine_scores(node_similarity, self._ref_counts, self._layers, self._layer_table, keyword_counts, edge_counts,
+                       self.keyword_importance, self.edge_importance, self.min_layer_edge_context, scores)
+
+        # Nodes without SANM references keep a score of 0
+        attention_scores = np.zeros(len(self._node_ids), dtype=np.float32)
+        attention_scores[self._active_positions] = scores
+        # The per-node lines are only formatted when DEBUG logging is on
+        if logger.isEnabledFor(logging.DEBUG):
+            for row, position in enumerate(self._active_positions):
+                 logger.debug("  Node: %s, Similarity: %.2f, Layer: %d, Keyword Matches: %.0f, Edge Matches: %.0f, Attention Score: %.2f",
+                              self._node_ids[position], node_similarity[row] / self._ref_counts[row], self._layers[row],
+                              keyword_counts[row], edge_counts[row], scores[row])
+            for position in self._inactive_positions:
+                 logger.debug("  Node: %s, No sanm_reference, Attention Score: 0.00", self._node_ids[position])
+
+        return AttentionResult(self._node_ids, attention_scores)
+
+    def _similarity_totals(self, query_indices, query_values, query_magnitude):
+        """
+        Sums the cosine similarities between the query and query * sanm_ref over each node's vector references.
+        Only the query's features matter, so the references are gathered over them and handed to SimSIMD's
+        batch cosine when it is installed and the gathered matrix is small enough; otherwise the sparse kernel is used.
+
+        Args:
+            query_indices (np.ndarray): Sorted int32 feature indices of the query.
+            query_values (np.ndarray): The query's values at those indices.
+            query_magnitude (float): The L2 norm of the query.
+        Returns:
+            np.ndarray: The similarity total of every node with SANM references.
+        """
+        active_count = len(self._active_positions)
+        ref_count = self._ref_matrix.shape[0]
+        if (simsimd is not None and ref_count and query_magnitude > 0
+                and ref_count * query_indices.size <= SIMSIMD_MAX_ELEMENTS):
+            query = query_values.astype(np.float32)
+            masked_refs = self._ref_matrix[:, query_indices].toarray() * query
+            # A zero row has cosine distance 1, matching the kernel's similarity of 0
+            similarities = 1.0 - np.asarray(simsimd.cdist(query[np.newaxis], masked_refs, metric='cosine')).ravel()
+            return np.bincount(self._ref_to_node, weights=similarities, minlength=active_count)
+        node_similarity = np.zeros(active_count)
+        accumulate(query_indices, query_values, query_magnitude,
+                   self._ref_matrix.data, self._ref_matrix.indices, self._ref_matrix.indptr,
+                   self._ref_to_node, node_similarity)
+        return node_similarity
+
+    def _build_node_index(self, hkg_nodes, hkg_graph):
+        """
+        Partitions the nodes into those with and without SANM references. The former are
+        flattened into parallel arrays (ids, layers, reference counts), and their SANM references
+        into one CSR matrix (one row per reference) with sorted indices, as the similarity
+        kernel merge-intersects them with the query.
+        Description tokens are mapped to a vocabulary: the node token matrix marks the tokens of
+        each node's description, and the edge token matrix counts the tokens of the descriptions
+        of each node's is_a targets, once per edge.
+
+        Args:
+            hkg_nodes (list):  A list of tuples, where each tuple contains
+                                   (node_id, node_data) from HKG-AG.
+            hkg_graph (networkx.MultiDiGraph): A graph object that contains the edges of the HKG_AG
+        """
+        node_ids = []
+        active_positions = []
+        inactive_positions = []
+        layers = []
+        ref_counts = []
+        vocabulary = {}
+        node_token_entries = ([], [])
+        edge_token_entries = ([], [])
+        rows = []
+        ref_to_node = []
+        scalar_signs = []
+        scalar_to_node = []
+        for position, (node_id, node_data) in enumerate(hkg_nodes):
+            node_ids.append(node_id)
+            if not node_data.get('sanm_references'):
+                inactive_positions.append(position)
+                continue
+            row = len(active_positions)
+            active_positions.append(position)
+            layers.append(node_data['layer'])
+            ref_counts.append(len(node_data['sanm_references']))
+            for token in self._description_tokens(node_data) or ():
+                node_token_entries[0].append(row)
+                node_token_entries[1].append(vocabulary.setdefault(token, len(vocabulary)))
+            for source_id, target_id, key, data in hkg_graph.out_edges(node_id, keys = True, data=True):
+                if data['relation'] == "is_a":
+                    for token in self._description_tokens(hkg_graph.nodes.get(target_id, {})) or ():
+                        edge_token_entries[0].append(row)
+                        edge_token_entries[1].append(vocabulary.setdefault(token, len(vocabulary)))
+            for sanm_ref in node_data['sanm_references']:
+                ref_array = np.asarray(sanm_ref, dtype=float)
+                if ref_array.ndim == 0:
+                    scalar_signs.append(np.sign(ref_array))
+                    scalar_to_node.append(row)
                 else:
-                     average_similarity = 0
-
-                layer_multiplier = self.layer_importance[node_data['layer']] if node_data['layer'] < len(self.layer_importance) else 1.0
-
-                keyword_score = 0
-                if node_data['layer'] >= 2 and 'data' in node_data and 'description' in node_data['data']:
-                     for keyword, _ in query_chunk.items():
-                         if str(keyword) in node_data['data']['description']:
-                             keyword_score += self.keyword_importance
-
-                edge_score = 0
-                if node_data['layer'] >= self.min_layer_edge_context:
-                     for source_id, target_id, key, data in hkg_graph.edges(keys = True, data=True):
-                         if source_id == node_id and data['relation'] == "is_a":
-                             target_node_data = hkg_graph.nodes.get(target_id, {})
-                             if 'data' in target_node_data and 'description' in target_node_data['data']:
-                                 for keyword, _ in query_chunk.items():
-                                     if str(keyword) in target_node_data['data']['description']:
-                                         edge_score += self.edge_importance
-
-                attention_score = average_similarity * layer_multiplier + keyword_score + edge_score
-                attention_scores[node_id] = attention_score
-                logging.debug(f"  Node: {node_id}, Similarity: {average_similarity:.2f}, Layer: {node_data['layer']}, Layer Multiplier: {layer_multiplier:.2f}, Keyword Score: {keyword_score:.2f}, Edge Score: {edge_score:.2f}, Attention Score: {attention_score:.2f}")
-             else:
-                attention_scores[node_id] = 0
-                logging.debug(f"  Node: {node_id}, No sanm_reference, Attention Score: 0.00")
-
-        return attention_scores
-
-    def _dict_to_sparse(self, information_chunk):
-        """Converts a dictionary to a sparse matrix"""
+                    rows.append(ref_array)
+                    ref_to_node.append(row)
+        if rows:
+            # float32 halves the bytes the similarity kernel streams; it still accumulates in float64
+            self._ref_matrix = csr_matrix(np.vstack(rows), dtype=np.float32)
+        else:
+            self._ref_matrix = csr_matrix((0, self.feature_dimension), dtype=np.float32)
+        self._ref_matrix.sort_indices()
+        # Filled element-wise so that tuple node ids stay scalars of the object array
+        self._node_ids = np.empty(len(node_ids), dtype=object)
+        for position, node_id in enumerate(node_ids):
+            self._node_ids[position] = node_id
+        # Every AttentionResult shares this array, so callers must not reorder it
+        self._node_ids.flags.writeable = False
+        self._active_positions = np.array(active_positions, dtype=np.intp)
+        self._inactive_positions = np.array(inactive_positions, dtype=np.intp)
+        self._layers = np.array(layers, dtype=np.int64)
+        self._ref_counts = np.array(ref_counts, dtype=np.int64)
+        self._vocabulary = vocabulary
+        token_shape = (len(active_positions), len(vocabulary))
+        # Duplicate (node, token) entries are summed, so repeated is_a edges count repeatedly
+        self._node_token_matrix = csr_matrix((np.ones(len(node_token_entries[0]), dtype=np.float32), node_token_entries), shape=token_shape)
+        self._edge_token_matrix = csr_matrix((np.ones(len(edge_token_entries[0]), dtype=np.float32), edge_token_entries), shape=token_shape)
+        self._ref_to_node = np.array(ref_to_node, dtype=np.intp)
+        self._scalar_signs = np.array(scalar_signs, dtype=float)
+        self._scalar_to_node = np.array(scalar_to_node, dtype=np.intp)
+        self._indexed_nodes = hkg_nodes
+        self._indexed_graph = hkg_graph
+        self._indexed_version = graph_version(hkg_graph)
+        logger.debug("Node index built over %d of %d nodes with %d vector and %d scalar references",
+                     len(active_positions), len(node_ids), self._ref_matrix.shape[0], len(scalar_signs))
+
+    def _description_tokens(self, node_data):
+        """Returns the description tokens of a node, or None when it has no description."""
+        data_tokens = node_data.get('data_tokens')
+        if data_tokens is not None:
+            return data_tokens.get('description')
+        if 'data' in node_data and 'description' in node_data['data']:
+            return tokenize(node_data['data']['description'])
+        return None
+
+    def _parsed_query(self, query_chunk):
+        """
+        Returns the parsed query and its magnitude, reusing the result for a query with the same items.
+
+        Args:
+            query_chunk (dict): A dictionary mapping feature index to value.
+        Returns:
+            tuple: Read-only int32 feature indices and float64 values (see _parse_query), and the query's L2 norm.
+        Raises:
+            ValueError: If a feature index falls outside the feature dimension.
+        """
+        try:
+            return self._parse_query_items(frozenset(query_chunk.items()), self.feature_dimension)
+        except TypeError:
+            # Unhashable values cannot key the cache
+            return self._parse_query_items.__wrapped__(query_chunk.items(), self.feature_dimension)
+
+    def _parse_query_items(self, items, feature_dimension):
+        """Parses the query items and computes the magnitude; the arrays are shared between calls so they are made read-only."""
+        indices, values = self._parse_query(dict(items))
+        indices.flags.writeable = False
+        values.flags.writeable = False
+        return indices, values, self._magnitude(values)
+
+    def _parse_query(self, query_chunk):
+        """
+        Converts a query dictionary into raw arrays, skipping SciPy's sparse-matrix construction overhead.
+
+        Args:
+            query_chunk (dict): A dictionary mapping feature index to value.
+        Returns:
+            tuple: Sorted, unique int32 feature indices and their float64 values.
+        Raises:
+            ValueError: If a feature index falls outside the feature dimension.
+        """
         indices = []
-        data = []
-        for feature, value in information_chunk.items():
+        values = []
+        for feature, value in query_chunk.items():
             try:
                 index = int(feature)
                 indices.append(index)
-                data.append(value)
+                values.append(value)
             except ValueError:
-                logging.warning(f"Skipping non-integer feature key: '{feature}'")
-        return csr_matrix((data, ([0] * len(data), indices)), shape=(1, self.feature_dimension))
+                logger.warning("Skipping non-integer feature key: '%s'", feature)
+        indices = np.array(indices, dtype=np.int64)
+        values = np.array(values, dtype=float)
+        if indices.size and (indices.min() < 0 or indices.max() >= self.feature_dimension):
+            raise ValueError(f"Feature index out of range for feature dimension {self.feature_dimension}: {indices.tolist()}")
+        order = np.argsort(indices, kind='stable')
+        indices = indices[order]
+        values = values[order]
+        # Keys such as "1" and "01" name the same feature, so their values add up
+        unique_indices, starts = np.unique(indices, return_index=True)
+        if unique_indices.size != indices.size:
+            values = np.add.reduceat(values, starts)
+        return unique_indices.astype(np.int32), values
 
-    def _array_to_sparse(self, array):
-        """Converts an array to a sparse matrix"""
-        data = []
-        indices = []
-        for index, value in enumerate(array):
-            if value != 0:
-                data.append(value)
-                indices.append(index)
-
-        return csr_matrix((data, ([0] * len(data), indices)), shape=(1, len(array)))
+    def _magnitude(self, values):
+        """Calculates the L2 norm of a sparse vector from its non-zero values."""
+        return np.sqrt(np.dot(values, values))
 
-    def _calculate_similarity(self, chunk1, chunk2):
-        """Calculates the cosine similarity between two sparse matrices."""
-        dot_product = chunk1.dot(chunk2.T).toarray()[0][0]
-        magnitude1 = np.sqrt(chunk1.dot(chunk1.T).toarray()[0][0])
-        magnitude2 = np.sqrt(chunk2.dot(chunk2.T).toarray()[0][0])
-
-        if magnitude1 == 0 or magnitude2 == 0:
-            return 0.0
-        similarity = dot_product / (magnitude1 * magnitude2)
-        return similarity
 
 if __name__ == "__main__":
+    # Configure logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
      # Example Usage
     from hkg_ag import HKG_AG
 
@@ -137,5 +335,5 @@ if __name__ == "__main__":
     # Run the CSAM
     attention_scores = csam.attend(mock_query, mock_hkg_nodes, hkg.graph)
     print("\nAttention Scores:")
-    for node_id, score in attention_scores.items():
+    for node_id, score in zip(attention_scores.node_ids, attention_scores.scores):
          print(f"  Node: {node_id}, Score: {score:.2f}")
\ No newline at end of file
@@ -0,0 +1,98 @@
+import numpy as np
+from numba import njit, prange
+
+# Rows longer than this many times the query's nnz are intersected by binary search instead of a merge
+GALLOP_RATIO = 8
+
+@njit(parallel=True, cache=True, fastmath=True)
+def reference_similarities(q_ind, q_val, q_magnitude, r_data, r_indices, r_indptr, out):
+    """
+    Computes cos(q, q * r) for every reference row r, in parallel over the rows.
+
+    Args:
+        q_ind (np.ndarray): Sorted feature indices of the query's non-zero entries.
+        q_val (np.ndarray): Values of the query's non-zero entries.
+        q_magnitude (float): The L2 norm of the query.
+        r_data, r_indices, r_indptr (np.ndarray): The CSR arrays of the reference matrix, with sorted, unique indices per row.
+        out (np.ndarray): One similarity slot per reference row, written in place.
+    """
+    n_query = q_ind.size
+    for row in prange(r_indptr.size - 1):
+        dot_product = 0.0
+        squared_magnitude = 0.0
+        j = r_indptr[row]
+        end = r_indptr[row + 1]
+        if end - j > GALLOP_RATIO * n_query:
+            # The row is much longer than the query: binary-search each query index in the rest of the row
+            for i in range(n_query):
+                j += np.searchsorted(r_indices[j:end], q_ind[i])
+                if j == end:
+                    break
+                if r_indices[j] == q_ind[i]:
+                    scaled = q_val[i] * r_data[j]
+                    dot_product += q_val[i] * scaled
+                    squared_magnitude += scaled * scaled
+                    j += 1
+        else:
+            # Merge-intersect the sorted query indices with the row's sorted indices
+            i = 0
+            while i < n_query and j < end:
+                if q_ind[i] == r_indices[j]:
+                    scaled = q_val[i] * r_data[j]
+                    dot_product += q_val[i] * scaled
+                    squared_magnitude += scaled * scaled
+                    i += 1
+                    j += 1
+                elif q_ind[i] < r_indices[j]:
+                    i += 1
+                else:
+                    j += 1
+        if squared_magnitude > 0.0 and q_magnitude > 0.0:
+            out[row] = dot_product / (q_magnitude * np.sqrt(squared_magnitude))
+        else:
+            out[row] = 0.0
+
+@njit(cache=True)
+def accumulate(q_ind, q_val, q_magnitude, r_data, r_indices, r_indptr, ref_to_node, out_sum):
+    """
+    Adds cos(q, q * r) of every reference row r to the similarity total of its node.
+
+    Args:
+        q_ind, q_val, q_magnitude, r_data, r_indices, r_indptr: See reference_similarities.
+        ref_to_node (np.ndarray): The node position of every reference row.
+        out_sum (np.ndarray): Per-node similarity totals, updated in place.
+    """
+    similarities = np.empty(r_indptr.size - 1)
+    reference_similarities(q_ind, q_val, q_magnitude, r_data, r_indices, r_indptr, similarities)
+    # Several rows share a node, so the reduction stays serial
+    for row in range(similarities.size):
+        out_sum[ref_to_node[row]] += similarities[row]
+
+@njit(cache=True, fastmath=True)
+def combine_scores(similarity_totals, ref_counts, layers, layer_table, keyword_counts, edge_counts,
+                   keyword_importance, edge_importance, min_layer_edge_context, out):
+    """
+    Combines the per-node terms into attention scores. The CSAM weights are plain arguments, so
+    changing them reuses the one compiled kernel instead of compiling a new one.
+
+    Args:
+        similarity_totals (np.ndarray): Per-node sums of the reference similarities.
+        ref_counts (np.ndarray): Per-node number of SANM references.
+        layers (np.ndarray): Per-node layer.
+        layer_table (np.ndarray): The padded multiplier table whose last entry is used for all deeper layers.
+        keyword_counts (np.ndarray): Per-node number of query keywords found in its description.
+        edge_counts (np.ndarray): Per-node number of query keywords found in its is_a targets' descriptions.
+        keyword_importance (float): Score added per query keyword found in a node's description (layer >= 2).
+        edge_importance (float): Score added per query keyword found in an is_a target's description.
+        min_layer_edge_context (int): The minimum layer at which edge context is added.
+        out (np.ndarray): One score slot per node, written in place.
+    """
+    last_layer = layer_table.size - 1
+    for row in range(out.size):
+        layer = layers[row]
+        score = similarity_totals[row] / ref_counts[row] * layer_table[min(layer, last_layer)]
+        if layer >= 2:
+            score += keyword_importance * keyword_counts[row]
+        if layer >= min_layer_edge_context:
+            score += edge_importance * edge_counts[row]
+        out[row] = score
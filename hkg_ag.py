@@ -1,6 +1,16 @@
 import networkx as nx
 from data.mock_hkg import get_mock_hkg_data
 import copy
+import re
+
+def tokenize(text):
+    """Splits text into a frozenset of lowercase word tokens."""
+    return frozenset(re.findall(r'\w+', text.lower()))
+
+def graph_version(graph):
+    """Returns the version HKG_AG keeps in the graph's attributes, or None for other graphs."""
+    graph_attributes = getattr(graph, 'graph', None)
+    return graph_attributes.get('version') if isinstance(graph_attributes, dict) else None
 
 class HKG_AG:
     def __init__(self):
@@ -9,6 +19,10 @@ class HKG_AG:
         and loads data from mock_hkg.py
         """
         self.graph = nx.MultiDiGraph() # Use a MultiDiGraph to allow multiple edges between nodes
+        # Bumped by every HKG_AG mutator; kept on the graph so consumers holding only the graph (CSAM) can see it
+        self.graph.graph['version'] = 0
+        self._nodes_snapshot = ()
+        self._snapshot_dirty = True
         self._load_mock_data()
 
     def _load_mock_data(self):
@@ -52,8 +66,10 @@ class HKG_AG:
             'sanm_references': sanm_references,
              'data': data if data else {},
         }
+        node_data['data_tokens'] = self._tokenize_data(node_data['data'])
         
         self.graph.add_node(node_id, **node_data)
+        self._mark_changed()
         print(f"Node '{name}' with id '{node_id}' added to layer {layer}.")
 
     def add_edge(self, source_id, target_id, relation, data = None):
@@ -78,6 +94,7 @@ class HKG_AG:
             'data': data if data else {}
         }
         self.graph.add_edge(source_id, target_id, **edge_data)
+        self._mark_changed()
         print(f"Edge '{relation}' added from '{source_id}' to '{target_id}'.")
     
     def update_node_layer(self, node_id, new_layer, remap_edges = False):
@@ -88,6 +105,7 @@ class HKG_AG:
         
         old_layer = self.graph.nodes[node_id]['layer']
         self.graph.nodes[node_id]['layer'] = new_layer
+        self._mark_changed()
         print(f"Node '{node_id}' moved from layer: '{old_layer}' to layer: '{new_layer}'")
 
         if remap_edges:
@@ -108,7 +126,15 @@ class HKG_AG:
              print(f"Error: Node with id '{node_id}' not found.")
              return
         self.graph.nodes[node_id]['data'] = data
+        self.graph.nodes[node_id]['data_tokens'] = self._tokenize_data(data)
+        self._mark_changed()
         print(f"Node '{node_id}' data updated.")
+
+    def _tokenize_data(self, data):
+        """Tokenizes the text attributes of node data so keyword checks become set lookups."""
+        if not data:
+            return {}
+        return {attribute: tokenize(value) for attribute, value in data.items() if isinstance(value, str)}
     
     def update_edge_data(self, source_id, target_id, key, data):
         """Updates the data of an existing edge"""
@@ -116,6 +142,7 @@ class HKG_AG:
             print(f"Error: Edge from '{source_id}' to '{target_id}' with key '{key}' not found.")
             return
         self.graph.edges[source_id, target_id, key]['data'] = data
+        self._mark_changed()
         print(f"Edge from '{source_id}' to '{target_id}' data updated.")
     
     def get_node(self, node_id):
@@ -132,6 +159,23 @@ class HKG_AG:
             return None
         return self.graph.edges[source_id, target_id, key]
     
+    def _mark_changed(self):
+        """Invalidates the node snapshot and bumps the graph version after a mutation."""
+        self._snapshot_dirty = True
+        self.graph.graph['version'] += 1
+
+    def nodes_snapshot(self):
+        """
+        Returns a tuple of (node_id, node_data) tuples for all nodes. The same tuple is returned until
+        the graph is changed through one of the HKG_AG methods, so consumers such as CSAM can reuse
+        work keyed on it; it is immutable so that no caller can reorder it under them. Changes made
+        directly on self.graph are not tracked.
+        """
+        if self._snapshot_dirty:
+            self._nodes_snapshot = tuple(self.graph.nodes(data=True))
+            self._snapshot_dirty = False
+        return self._nodes_snapshot
+
     def get_nodes_in_layer(self, layer):
          """Returns all nodes in a specific layer."""
          nodes_in_layer = [
@@ -188,6 +232,7 @@ class HKG_AG:
       #Remove the old nodes
       for node_id in node_ids:
          self.graph.remove_node(node_id)
+         self._mark_changed()
          print(f"Removed Node: '{node_id}'")
       
       print("Node Merge Completed")
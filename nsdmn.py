@@ -2,6 +2,7 @@ from sanm import SANM
 from hkg_ag import HKG_AG
 from csam import CSAM
 from data.mock_data import get_initial_data
+import logging
 
 class NSDMN:
     def __init__(self, feature_dimension):
@@ -30,22 +31,25 @@ class NSDMN:
             query_chunk (dict): A dictionary representing the sparse
                                        representation of the query.
         Returns:
-            dict: A dictionary mapping node_id to the attention score.
+            AttentionResult: The node ids and their attention scores, in HKG node order.
          """
          print("\n--- Processing Query ---")
          #Get the query results from SANM
          sanm_results = self.sanm.query(query_chunk)
 
-         #Get all of the nodes from HKG_AG
-         hkg_nodes = [(node_id, data) for node_id, data in self.hkg.graph.nodes(data=True)]
+         #Get all of the nodes from HKG_AG; the snapshot is shared between queries until the graph changes
+         hkg_nodes = self.hkg.nodes_snapshot()
 
          #Get the attention scores from CSAM
-         attention_scores = self.csam.attend(query_chunk=query_chunk, hkg_nodes = hkg_nodes)
+         attention_scores = self.csam.attend(query_chunk=query_chunk, hkg_nodes = hkg_nodes, hkg_graph = self.hkg.graph)
          print("--- Query Processing Completed ---")
          return attention_scores
 
 
 if __name__ == "__main__":
+    # Configure logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
     # Determine the feature dimension (max feature index + 1)
     initial_data = get_initial_data()
     feature_dimension = 0
@@ -64,7 +68,7 @@ if __name__ == "__main__":
     
     #print out the results
     print("\nFinal Attention Scores:")
-    for node_id, score in attention_scores.items():
+    for node_id, score in zip(attention_scores.node_ids, attention_scores.scores):
          print(f"  Node: {node_id}, Score: {score:.2f}")
 
     # Create a mock query
@@ -74,5 +78,5 @@ if __name__ == "__main__":
     
     #print out the results
     print("\nFinal Attention Scores:")
-    for node_id, score in attention_scores_2.items():
+    for node_id, score in zip(attention_scores_2.node_ids, attention_scores_2.scores):
          print(f"  Node: {node_id}, Score: {score:.2f}")
\ No newline at end of file
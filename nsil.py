@@ -1,9 +1,17 @@
 import numpy as np
+import heapq
+from collections import ChainMap
+from operator import itemgetter
 from scipy.sparse import csr_matrix
+from hkg_ag import graph_version, tokenize
 import logging
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Number of nodes with SANM references whose references are combined and rules applied
+TOP_NODE_COUNT = 5
+# Highest-scoring nodes taken with a partial sort before falling back to sorting all of them
+TOP_NODE_CANDIDATES = 64
 
 class NSIL:
     def __init__(self, feature_dimension, rule_importance = 0.1):
@@ -27,7 +35,22 @@ class NSIL:
                  "target_attributes": ["location"]
             }
         ]
-        logging.info("NSIL initialized")
+        self._reference_sums = {}
+        self._reference_graph = None
+        self._reference_version = None
+        logger.info("NSIL initialized")
+
+    @property
+    def rules(self):
+        return self._rules
+
+    @rules.setter
+    def rules(self, rules):
+        """Groups the rules by relation so each edge looks up only the rules for its relation."""
+        self._rules = rules
+        self._rule_map = {}
+        for rule in rules:
+            self._rule_map.setdefault(rule["if_relation"], []).append(rule)
 
     def integrate(self, query_chunk, attention_scores, sanm, hkg):
         """
@@ -42,85 +65,160 @@ class NSIL:
         Returns:
             tuple: A tuple containing:
                 csr_matrix: A combined sparse vector of the most relevant SANM references.
-                dict: A dictionary mapping node_id to the updated attention scores.
+                ChainMap: A mapping of node_id to the updated attention scores. Boosted scores are stored in
+                          its own dictionary in front of attention_scores, which is left unchanged.
         """
-        logging.info("\n--- Integrating ---")
-        # Sort nodes by attention score
-        sorted_nodes = sorted(attention_scores.items(), key = lambda item: item[1], reverse = True)
-
-        combined_vector = csr_matrix((1, self.feature_dimension))
+        logger.info("\n--- Integrating ---")
+        debug_enabled = logger.isEnabledFor(logging.DEBUG)
+        # Each node is looked up in the HKG once per call
+        node_cache = {}
+        def get_node(node_id):
+            if node_id not in node_cache:
+                node_cache[node_id] = hkg.get_node(node_id)
+            return node_cache[node_id]
+        # Keywords match whole description tokens, as in CSAM
+        query_keywords = {str(keyword).lower() for keyword in query_chunk}
 
         #Get top nodes with SANM references
         top_nodes = []
-        for node_id, score in sorted_nodes:
-            node_data = hkg.get_node(node_id)
+        for node_id, score in self._ranked_nodes(attention_scores):
+            node_data = get_node(node_id)
             if node_data and node_data.get('sanm_references'):
-                top_nodes.append(node_id)
-                logging.debug(f"  Top Node: {node_id}, Score: {score:.2f}")
-            if len(top_nodes) >= 5:
+                top_nodes.append((node_id, node_data))
+                if debug_enabled:
+                    logger.debug("  Top Node: %s, Score: %.2f", node_id, score)
+            if len(top_nodes) >= TOP_NODE_COUNT:
                 break
 
-        #Combine SANM References
-        for node_id in top_nodes:
-            node_data = hkg.get_node(node_id)
-            if node_data and node_data.get('sanm_references'):
-                for sanm_ref in node_data['sanm_references']:
-                    sparse_vector = self._array_to_sparse(self._dict_to_sparse(query_chunk).toarray().flatten() * sanm_ref)
-                    combined_vector += sparse_vector
+        #Combine SANM References; query * ref is linear in ref, so the references are summed first and multiplied once
+        if top_nodes:
+            reference_sum = np.zeros(self.feature_dimension, dtype=np.float32)
+            for node_id, node_data in top_nodes:
+                reference_sum += self._reference_sum(node_id, node_data, hkg.graph)
+            combined_dense = self._dict_to_sparse(query_chunk).toarray().ravel().astype(np.float32) * reference_sum
+            nonzero = np.flatnonzero(combined_dense)
+            combined_vector = csr_matrix((combined_dense[nonzero], nonzero, np.array([0, nonzero.size])), shape=(1, self.feature_dimension))
+        else:
+            # Without references the query is never parsed, as before
+            combined_vector = csr_matrix((1, self.feature_dimension), dtype=np.float32)
 
         #Apply rules
-        updated_attention_scores = attention_scores.copy()
-        for node_id in top_nodes:
-             node_data = hkg.get_node(node_id)
-             if node_data:
-                 for source_id, target_id, key, data in hkg.graph.edges(keys = True, data = True):
-                      if source_id == node_id:
-                           for rule in self.rules:
-                                if data['relation'] == rule['if_relation']:
-                                    if target_id in updated_attention_scores:
-
-                                        keyword_score = 0
-                                        target_node_data = hkg.get_node(target_id)
-                                        if target_node_data and 'data' in target_node_data:
-                                            for target_attribute in rule["target_attributes"]:
-                                                if target_attribute in target_node_data['data']:
-                                                  for keyword, _ in query_chunk.items():
-                                                       if str(keyword) in target_node_data['data'][target_attribute]:
-                                                          keyword_score += self.rule_importance
-                                        if rule["then_boost"]:
-                                          updated_attention_scores[target_id] += keyword_score
-                                          logging.debug(f"  Rule applied, boosting node: '{target_id}' due to node: '{source_id}' having a '{rule['if_relation']}' relation, new score: {updated_attention_scores[target_id]:.2f}")
-                                        else:
-                                             updated_attention_scores[target_id] -= keyword_score
-                                             logging.debug(f"  Rule applied, reducing node: '{target_id}' due to node: '{source_id}' having a '{rule['if_relation']}' relation, new score: {updated_attention_scores[target_id]:.2f}")
-        logging.info("--- Integration Complete ---")
+        # Only the scores the rules change are stored; the rest are read through from attention_scores
+        updated_attention_scores = ChainMap({}, attention_scores)
+        keyword_scores = {}
+        for node_id, node_data in top_nodes:
+             # Only the node's own adjacency is walked, not every edge of the graph
+             for source_id, target_id, key, data in hkg.graph.out_edges(node_id, keys = True, data = True):
+                 for rule in self._rule_map.get(data['relation'], ()):
+                      score = updated_attention_scores.get(target_id)
+                      if score is None:
+                          continue
+
+                      # The keyword score only depends on the target and the rule, so it is shared by every edge into the target
+                      keyword_score = keyword_scores.get((target_id, id(rule)))
+                      if keyword_score is None:
+                          keyword_score = self._keyword_score(rule, get_node(target_id), query_keywords)
+                          keyword_scores[(target_id, id(rule))] = keyword_score
+                      boost = rule["then_boost"]
+                      score = score + keyword_score if boost else score - keyword_score
+                      updated_attention_scores[target_id] = score
+                      if debug_enabled:
+                          logger.debug("  Rule applied, %s node: %r due to node: %r having a %r relation, new score: %.2f",
+                                       'boosting' if boost else 'reducing', target_id, source_id, rule['if_relation'], score)
+        logger.info("--- Integration Complete ---")
         return combined_vector, updated_attention_scores
 
+    def _reference_sum(self, node_id, node_data, hkg_graph):
+        """
+        Returns the float32 sum of a node's SANM references. Sums are computed once per node and reused,
+        like CSAM's node index, while the same graph is passed in and its 'version' attribute (bumped by
+        every HKG_AG mutator) is unchanged; references edited any other way are not detected.
+
+        Args:
+            node_id (str or int): The id of the node.
+            node_data (dict): The node data holding its sanm_references.
+            hkg_graph (networkx.MultiDiGraph): The graph of the HKG_AG the node belongs to.
+        Returns:
+            np.ndarray: The float32 reference sum, shared between calls.
+        """
+        version = graph_version(hkg_graph)
+        if hkg_graph is not self._reference_graph or version != self._reference_version:
+            self._reference_sums = {}
+            self._reference_graph = hkg_graph
+            self._reference_version = version
+        reference_sum = self._reference_sums.get(node_id)
+        if reference_sum is None:
+            # Cast to float32 once, when the node is first summed; the in-place add needs no float32 copy of each reference
+            reference_sum = np.zeros(self.feature_dimension, dtype=np.float32)
+            for sanm_ref in node_data['sanm_references']:
+                reference_sum += sanm_ref
+            self._reference_sums[node_id] = reference_sum
+        return reference_sum
+
+    def _keyword_score(self, rule, target_node_data, query_keywords):
+        """
+        Scores how many query keywords appear among the tokens of the rule's target attributes.
+
+        Args:
+            rule (dict): The rule whose target_attributes are checked.
+            target_node_data (dict): The node data of the edge's target, or None.
+            query_keywords (set): The lowercased query keywords.
+        Returns:
+            float: rule_importance per keyword found, summed over the target attributes.
+        """
+        if not target_node_data:
+            return 0
+        target_data = target_node_data.get('data') or {}
+        data_tokens = target_node_data.get('data_tokens', {})
+        keyword_score = 0
+        for target_attribute in rule["target_attributes"]:
+            text = target_data.get(target_attribute)
+            if text is None:
+                continue
+            target_tokens = data_tokens.get(target_attribute)
+            if target_tokens is None:
+                target_tokens = tokenize(str(text))
+            keyword_score += self.rule_importance * len(query_keywords & target_tokens)
+        return keyword_score
+
+    def _ranked_nodes(self, attention_scores):
+        """
+        Yields (node_id, score) pairs by descending score, ties in dictionary order. Only the top
+        TOP_NODE_CANDIDATES are partially sorted up front; the rest are sorted only if the caller reads past them.
+        """
+        candidates = heapq.nlargest(TOP_NODE_CANDIDATES, attention_scores.items(), key=itemgetter(1))
+        yield from candidates
+        if len(candidates) < len(attention_scores):
+            yield from sorted(attention_scores.items(), key=itemgetter(1), reverse=True)[len(candidates):]
+
     def _dict_to_sparse(self, information_chunk):
-        """Converts a dictionary to a sparse matrix"""
-        indices = []
-        data = []
+        """Converts a dictionary to a sparse matrix, building the CSR arrays directly"""
+        features = []
+        values = []
         for feature, value in information_chunk.items():
-            try:
-                index = int(feature)
-                indices.append(index)
-                data.append(value)
-            except ValueError:
-                logging.warning(f"Skipping non-integer feature key: '{feature}'")
-        return csr_matrix((data, ([0] * len(data), indices)), shape=(1, self.feature_dimension))
-
-    def _array_to_sparse(self, array):
-        """Converts an array to a sparse matrix"""
-        data = []
-        indices = []
-        for index, value in enumerate(array):
-            if value != 0:
-                data.append(value)
-                indices.append(index)
-
-        return csr_matrix((data, ([0] * len(data), indices)), shape=(1, len(array)))
+            digits = str(feature)
+            if digits[:1] in ('-', '+'):
+                digits = digits[1:]
+            # Checking the digits up front avoids a try/except per key; int() accepts any decimal digits
+            if digits.isdecimal():
+                features.append(feature)
+                values.append(value)
+            else:
+                logger.warning("Skipping non-integer feature key: '%s'", feature)
+        count = len(features)
+        indices = np.fromiter(map(int, features), dtype=np.int32, count=count)
+        data = np.fromiter(values, dtype=np.float64, count=count)
+        if count and (indices.min() < 0 or indices.max() >= self.feature_dimension):
+            raise ValueError(f"Feature index out of range for feature dimension {self.feature_dimension}: {indices.tolist()}")
+        sparse_vector = csr_matrix((data, indices, np.array([0, count], dtype=np.int32)), shape=(1, self.feature_dimension))
+        # Keys such as "1" and "01" name the same feature
+        sparse_vector.sum_duplicates()
+        return sparse_vector
 
 if __name__ == "__main__":
+    # Configure logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
     from sanm import SANM
     from hkg_ag import HKG_AG
     from csam import CSAM
@@ -134,7 +232,7 @@ if __name__ == "__main__":
           try:
               feature_dimension = max(feature_dimension, int(feature))
           except ValueError:
-              logging.warning(f"Skipping non-integer feature key: '{feature}' during dimension calculation.")
+              logger.warning("Skipping non-integer feature key: '%s' during dimension calculation.", feature)
     feature_dimension += 1
 
     # Initialize components
@@ -154,7 +252,7 @@ if __name__ == "__main__":
 
     # Mock Attention Scores
     mock_hkg_nodes = [(node_id, data) for node_id, data in hkg.graph.nodes(data=True)]
-    attention_scores = csam.attend(mock_query, mock_hkg_nodes, hkg.graph)
+    attention_scores = csam.attend(mock_query, mock_hkg_nodes, hkg.graph).as_dict()
 
     # Integrate
     integrated_vector, updated_attention_scores = nsil.integrate(mock_query, attention_scores, sanm, hkg)
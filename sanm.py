@@ -1,11 +1,15 @@
 import numpy as np
 import sys
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, vstack
 from annoy import AnnoyIndex
+from sanm_kernel import sparse_cosine
 from data.mock_data import get_initial_data
 import os
 import time
 
+# Number of Annoy neighbours whose exact similarity is checked when adding to a built index
+ANNOY_CANDIDATES = 5
+
 class SANM:
     def __init__(self, feature_dimension, similarity_threshold=0.7, num_trees=10, index_path="sanm_index.ann"):
         """
@@ -19,10 +23,17 @@ class SANM:
             index_path (str): Path to store and load the annoy index
         """
         self.memory = []  # List of (sparse_matrix, index_in_annoy)
+        self._memory_matrix = None  # Row-normalized stack of the memory vectors, rebuilt lazily until the index is built
         self.similarity_threshold = similarity_threshold
         self.feature_dimension = feature_dimension
-        self.annoy_index = AnnoyIndex(feature_dimension, 'euclidean')
+        # Angular distance is cosine based, so vectors are handed to Annoy without normalizing them
+        self.annoy_index = AnnoyIndex(feature_dimension, 'angular')
         self.annoy_index_count = 0  # Keep track of the index in Annoy
+        self._annoy_to_mem_idx = {}  # Annoy item id -> position in self.memory
+        self._index_built = False
+        self._index_dirty = False  # Memory changed since the Annoy index was built
+        self._indexed_count = 0  # Memory rows covered by the built Annoy index
+        self._scratch = np.zeros(feature_dimension, dtype=np.float32)  # Dense buffer handed to Annoy, all zeros between calls
         self.num_trees = num_trees
         self.index_path = index_path
         self.index_loaded = False
@@ -33,11 +44,18 @@ class SANM:
             try:
                 self.annoy_index.load(self.index_path)
                 self.index_loaded = True
-                # Load existing memory from the loaded index
-                for i in range(self.annoy_index.get_n_items()):
-                    sparse_vector = self._array_to_sparse(self.annoy_index.get_item_vector(i))
+                # Load existing memory from the loaded index, sparsifying all item vectors in one pass
+                item_count = self.annoy_index.get_n_items()
+                vectors = np.array([self.annoy_index.get_item_vector(i) for i in range(item_count)], dtype=np.float32).reshape(item_count, feature_dimension)
+                loaded = csr_matrix(vectors)
+                for i in range(item_count):
+                    start, end = loaded.indptr[i], loaded.indptr[i + 1]
+                    sparse_vector = csr_matrix((loaded.data[start:end], loaded.indices[start:end], np.array([0, end - start])), shape=(1, feature_dimension))
                     self.memory.append((sparse_vector, i))
-                    self.annoy_index_count +=1
+                    self._annoy_to_mem_idx[i] = i
+                self.annoy_index_count = item_count
+                self._index_built = True
+                self._indexed_count = len(self.memory)
             except Exception as e:
                 print(f"Error loading index: {e}")
                 print("Creating New Index")
@@ -66,9 +84,19 @@ class SANM:
 
 
     def _build_index(self):
-         """Builds the annoy index"""
+         """Builds a fresh annoy index from the current memory vectors"""
          print(f"Building Annoy index with {self.num_trees} trees")
+         # A built index cannot take new or updated items, so the memory is inserted in one batch
+         self.annoy_index.unload()
+         self.annoy_index = AnnoyIndex(self.feature_dimension, 'angular')
+         for mem_sparse, mem_annoy in self.memory:
+             self._add_annoy_item(mem_annoy, mem_sparse)
          self.annoy_index.build(self.num_trees)
+         self._index_dirty = False
+         self._index_built = True
+         self._indexed_count = len(self.memory)
+         # add no longer scans the whole memory once the index is built
+         self._memory_matrix = None
 
     def add(self, information_chunk):
         """
@@ -83,8 +111,8 @@ class SANM:
         
         if not self.memory:
           self.memory.append((sparse_vector, self.annoy_index_count))
-          if not self.index_loaded:
-            self.annoy_index.add_item(self.annoy_index_count, self._normalize_vector(sparse_vector).toarray().flatten())
+          self._annoy_to_mem_idx[self.annoy_index_count] = 0
+          self._index_dirty = True
           self.annoy_index_count += 1
           print(f"  Added as the first chunk.")
           return
@@ -92,12 +120,23 @@ class SANM:
         best_match_index = -1
         max_similarity = 0
         
-        #Find the best_match using cosine similarity
-        for i, (mem_sparse, mem_annoy) in enumerate(self.memory):
-            similarity = self._calculate_similarity(sparse_vector, mem_sparse)
-            if similarity > max_similarity:
-                max_similarity = similarity
-                best_match_index = i
+        if self._index_built:
+            #Only Annoy's nearest candidates and the rows added since the build are compared exactly
+            candidate_ids = self._annoy_neighbors(sparse_vector, ANNOY_CANDIDATES)[0]
+            candidate_rows = [self._annoy_to_mem_idx[mem_annoy] for mem_annoy in candidate_ids]
+            candidate_rows.extend(range(self._indexed_count, len(self.memory)))
+            for i in candidate_rows:
+                similarity = self._calculate_similarity(sparse_vector, self.memory[i][0])
+                if similarity > max_similarity:
+                    max_similarity = similarity
+                    best_match_index = i
+        else:
+            #Find the best_match using cosine similarity against all memory vectors at once
+            similarities = (self._normalized_memory() @ self._normalize_vector(sparse_vector).T).toarray().ravel()
+            best = int(np.argmax(similarities))
+            if similarities[best] > 0:
+                max_similarity = similarities[best]
+                best_match_index = best
         if best_match_index != -1:
             print(f"Best Similarity Match {best_match_index}: Similarity: {max_similarity:.2f}")
         else:
@@ -107,26 +146,43 @@ class SANM:
         if max_similarity >= self.similarity_threshold:
             print(f"  Merging with chunk {best_match_index} (similarity: {max_similarity:.2f})")
             self.memory[best_match_index] = (self._merge_chunks(self.memory[best_match_index][0], sparse_vector), self.memory[best_match_index][1])
-            if not self.index_loaded:
-                self.annoy_index.add_item(self.memory[best_match_index][1], self._normalize_vector(self.memory[best_match_index][0]).toarray().flatten())
+            self._memory_matrix = None
         else:
             self.memory.append((sparse_vector, self.annoy_index_count))
-            if not self.index_loaded:
-                self.annoy_index.add_item(self.annoy_index_count, self._normalize_vector(sparse_vector).toarray().flatten())
+            self._annoy_to_mem_idx[self.annoy_index_count] = len(self.memory) - 1
+            # The stack only serves the linear scan used before the index is built
+            if self._memory_matrix is not None and not self._index_built:
+                self._memory_matrix = vstack([self._memory_matrix, self._normalize_vector(sparse_vector)], format='csr')
             self.annoy_index_count += 1
             print(f"  Added as a new chunk.")
 
+        self._index_dirty = True
         print(f"Current memory size: {len(self.memory)}")
         sys.stdout.flush()
     
-    def save_index(self):
-        """Saves the current Annoy Index"""
-        if not self.index_loaded:
-            self._build_index()
-            self.annoy_index.save(self.index_path)
-            print(f"Annoy index saved to {self.index_path}")
-        else:
+    def _normalized_memory(self):
+        """Returns the memory vectors, normalized, stacked as the rows of one CSR matrix."""
+        if self._memory_matrix is None:
+            self._memory_matrix = vstack([self._normalize_vector(mem_sparse) for mem_sparse, mem_annoy in self.memory], format='csr')
+        return self._memory_matrix
+
+    def save_index(self, overwrite=False):
+        """
+        Rebuilds the Annoy Index from memory if it changed since the last build, and saves it.
+
+        Args:
+            overwrite (bool): Whether an index loaded from index_path may be written back. By default a
+                              loaded index is only rebuilt in memory, so the file keeps the vectors it was loaded with.
+        """
+        if self._index_built and not self._index_dirty:
+            print(f"Index is already up to date.")
+            return
+        self._build_index()
+        if self.index_loaded and not overwrite:
             print(f"Index is already loaded and cannot be saved.")
+            return
+        self.annoy_index.save(self.index_path)
+        print(f"Annoy index saved to {self.index_path}")
 
     def query(self, query_chunk):
         """
@@ -138,22 +194,27 @@ class SANM:
                   for chunks that are similar to the query.
         """
         print(f"\nQuerying memory with: {query_chunk}")
+        if not self._index_built or self._index_dirty:
+            print("Error: Memory changed since the Annoy index was built, call save_index before querying.")
+            return []
         sparse_query = self._dict_to_sparse(query_chunk)
 
         # Find nearest neighbors using Annoy
-        nearest_neighbors = self.annoy_index.get_nns_by_vector(self._normalize_vector(sparse_query).toarray().flatten(), 10, include_distances=True)  # Get top 10 results
+        nearest_neighbors = self._annoy_neighbors(sparse_query, 10)  # Get top 10 results
         results = []
         
         if len(nearest_neighbors[0]) > 0:
             for i, mem_index in enumerate(nearest_neighbors[0]):
-                for index, (mem_sparse, mem_annoy) in enumerate(self.memory):
-                    if mem_index == mem_annoy:
-                        similarity = self._calculate_similarity(sparse_query, mem_sparse)
-                        if similarity >= self.similarity_threshold:
-                          results.append((mem_sparse, similarity))
-                          print(f"  Found match in chunk {index}: Similarity = {similarity:.2f}")
-                        else:
-                            print(f"  No match in chunk {index}: Similarity = {similarity:.2f}")
+                index = self._annoy_to_mem_idx.get(mem_index)
+                if index is None:
+                    continue
+                mem_sparse = self.memory[index][0]
+                similarity = self._calculate_similarity(sparse_query, mem_sparse)
+                if similarity >= self.similarity_threshold:
+                  results.append((mem_sparse, similarity))
+                  print(f"  Found match in chunk {index}: Similarity = {similarity:.2f}")
+                else:
+                    print(f"  No match in chunk {index}: Similarity = {similarity:.2f}")
 
 
         sorted_results = sorted(results, key=lambda item: item[1], reverse=True) # Sort by similarity
@@ -167,30 +228,43 @@ class SANM:
         return sorted_results
 
     def _dict_to_sparse(self, information_chunk):
-        """Converts a dictionary to a sparse matrix"""
-        indices = []
-        data = []
-        for feature, value in information_chunk.items():
-            indices.append(int(feature))
-            data.append(value)
-        sparse_vector = csr_matrix((data, ([0] * len(data), indices)), shape=(1, self.feature_dimension))
-        #print(f"Sparse Vector Before Add: {sparse_vector.toarray().flatten()}, Type: {type(sparse_vector.toarray().flatten())}")
+        """Converts a dictionary to a sparse matrix, building the CSR arrays directly"""
+        count = len(information_chunk)
+        indices = np.fromiter(map(int, information_chunk.keys()), dtype=np.int32, count=count)
+        data = np.fromiter(information_chunk.values(), dtype=np.float64, count=count)
+        if count and (indices.min() < 0 or indices.max() >= self.feature_dimension):
+            raise ValueError(f"Feature index out of range for feature dimension {self.feature_dimension}: {indices.tolist()}")
+        sparse_vector = csr_matrix((data, indices, np.array([0, count], dtype=np.int32)), shape=(1, self.feature_dimension))
+        # Keys such as "1" and "01" name the same feature
+        sparse_vector.sum_duplicates()
         return sparse_vector
     
-    def _array_to_sparse(self, array):
-        """Converts an array to a sparse matrix"""
-        data = []
-        indices = []
-        for index, value in enumerate(array):
-            if value != 0:
-                data.append(value)
-                indices.append(index)
-        
-        return csr_matrix((data, ([0] * len(data), indices)), shape=(1, self.feature_dimension))
-    
+    def _scatter_to_scratch(self, sparse_vector):
+        """Writes the sparse vector into the scratch buffer and returns the buffer."""
+        self._scratch[sparse_vector.indices] = sparse_vector.data
+        return self._scratch
+
+    def _clear_scratch(self, sparse_vector):
+        """Zeroes the scratch buffer entries written for the sparse vector."""
+        self._scratch[sparse_vector.indices] = 0.0
+
+    def _annoy_neighbors(self, sparse_vector, count):
+        """Returns the ids and distances of the sparse vector's nearest Annoy neighbours."""
+        try:
+            return self.annoy_index.get_nns_by_vector(self._scatter_to_scratch(sparse_vector), count, include_distances=True)
+        finally:
+            self._clear_scratch(sparse_vector)
+
+    def _add_annoy_item(self, item_id, sparse_vector):
+        """Adds the sparse vector to Annoy through the scratch buffer instead of a fresh dense array."""
+        try:
+            self.annoy_index.add_item(item_id, self._scatter_to_scratch(sparse_vector))
+        finally:
+            self._clear_scratch(sparse_vector)
+
     def _normalize_vector(self, sparse_vector):
         """Normalizes the sparse vector"""
-        norm = np.sqrt(sparse_vector.dot(sparse_vector.T).toarray()[0][0])
+        norm = np.sqrt(np.dot(sparse_vector.data, sparse_vector.data))
         if norm == 0:
            return sparse_vector
         return sparse_vector/norm
@@ -205,16 +279,11 @@ class SANM:
         return result
 
     def _calculate_similarity(self, chunk1, chunk2):
-        """Calculates the cosine similarity between two sparse matrices."""
-        dot_product = chunk1.dot(chunk2.T).toarray()[0][0]
-        magnitude1 = np.sqrt(chunk1.dot(chunk1.T).toarray()[0][0])
-        magnitude2 = np.sqrt(chunk2.dot(chunk2.T).toarray()[0][0])
-
-        if magnitude1 == 0 or magnitude2 == 0:
-            return 0.0
-        similarity = dot_product / (magnitude1 * magnitude2)
-        #print(f"Similarity of {similarity:.2f} for vectors {chunk1.toarray().flatten()} and {chunk2.toarray().flatten()}")
-        return similarity
+        """Calculates the cosine similarity between two sparse row vectors on their raw CSR arrays."""
+        # The kernel merges sorted indices; this is a no-op for vectors already in canonical form
+        chunk1.sum_duplicates()
+        chunk2.sum_duplicates()
+        return sparse_cosine(chunk1.data, chunk1.indices, chunk2.data, chunk2.indices)
 
     def _merge_chunks(self, chunk1, chunk2):
         """Merges two similar chunks (averaging shared features)."""
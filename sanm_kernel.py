@@ -0,0 +1,42 @@
+import numpy as np
+from numba import njit
+
+@njit(cache=True)
+def sparse_cosine(data1, indices1, data2, indices2):
+    """
+    Computes the cosine similarity of two sparse vectors in one merge pass over their sorted indices.
+
+    Args:
+        data1, indices1 (np.ndarray): Values and sorted, unique feature indices of the first vector.
+        data2, indices2 (np.ndarray): Values and sorted, unique feature indices of the second vector.
+    Returns:
+        float: The cosine similarity, or 0.0 if either vector has no magnitude.
+    """
+    dot_product = 0.0
+    squared_magnitude1 = 0.0
+    squared_magnitude2 = 0.0
+    a = 0
+    b = 0
+    while a < indices1.size and b < indices2.size:
+        if indices1[a] == indices2[b]:
+            dot_product += data1[a] * data2[b]
+            squared_magnitude1 += data1[a] * data1[a]
+            squared_magnitude2 += data2[b] * data2[b]
+            a += 1
+            b += 1
+        elif indices1[a] < indices2[b]:
+            squared_magnitude1 += data1[a] * data1[a]
+            a += 1
+        else:
+            squared_magnitude2 += data2[b] * data2[b]
+            b += 1
+    # Entries past the end of the other vector only add to their own magnitude
+    while a < indices1.size:
+        squared_magnitude1 += data1[a] * data1[a]
+        a += 1
+    while b < indices2.size:
+        squared_magnitude2 += data2[b] * data2[b]
+        b += 1
+    if squared_magnitude1 == 0.0 or squared_magnitude2 == 0.0:
+        return 0.0
+    return dot_product / (np.sqrt(squared_magnitude1) * np.sqrt(squared_magnitude2))
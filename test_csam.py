@@ -1,46 +1,116 @@
 import pytest
-from csam import CSAM
+import csam
+from csam import CSAM, AttentionResult
+from csam_kernel import accumulate, combine_scores, reference_similarities
 from unittest.mock import MagicMock
 import numpy as np
+import logging
 from scipy.sparse import csr_matrix
 
 @pytest.fixture
 def csam_instance():
     return CSAM(feature_dimension=100)
 
-def test_dict_to_sparse_valid_keys(csam_instance):
-    chunk = {"1": 0.5, "2": 0.8, "99": 0.2}
-    sparse_matrix = csam_instance._dict_to_sparse(chunk)
-    assert sparse_matrix.shape == (1, 100)
-    assert sparse_matrix[0, 1] == 0.5
-    assert sparse_matrix[0, 2] == 0.8
-    assert sparse_matrix[0, 99] == 0.2
+def test_parse_query_valid_keys(csam_instance):
+    chunk = {"99": 0.2, "1": 0.5, "2": 0.8}
+    indices, values = csam_instance._parse_query(chunk)
+    assert indices.dtype == np.int32
+    assert indices.tolist() == [1, 2, 99]
+    assert values.tolist() == [0.5, 0.8, 0.2]
 
-def test_dict_to_sparse_invalid_keys(csam_instance, caplog):
+def test_parse_query_invalid_keys(csam_instance, caplog):
     chunk = {"1": 0.5, "invalid": 0.8, "99": 0.2, "also_invalid": 0.1}
-    sparse_matrix = csam_instance._dict_to_sparse(chunk)
-    assert sparse_matrix.shape == (1, 100)
-    assert sparse_matrix[0, 1] == 0.5
-    assert sparse_matrix[0, 99] == 0.2
+    indices, values = csam_instance._parse_query(chunk)
+    assert indices.tolist() == [1, 99]
+    assert values.tolist() == [0.5, 0.2]
     assert "Skipping non-integer feature key: 'invalid'" in caplog.text
     assert "Skipping non-integer feature key: 'also_invalid'" in caplog.text
 
-def test_array_to_sparse(csam_instance):
-    array = [0, 1, 0, 2, 0]
-    sparse_matrix = csam_instance._array_to_sparse(array)
-    assert sparse_matrix.shape == (1, len(array))
-    assert sparse_matrix[0, 1] == 1
-    assert sparse_matrix[0, 3] == 2
+def test_parse_query_sums_duplicate_features(csam_instance):
+    indices, values = csam_instance._parse_query({"1": 0.5, "01": 0.25, "3": 0.1})
+    assert indices.tolist() == [1, 3]
+    assert values.tolist() == [0.75, 0.1]
 
-def test_calculate_similarity(csam_instance):
-    chunk1 = csr_matrix([[1, 0, 2]])
-    chunk2 = csr_matrix([[1, 0, 0]])
-    similarity = csam_instance._calculate_similarity(chunk1, chunk2)
-    assert similarity == pytest.approx(0.447, 0.001)
+def test_parse_query_out_of_range(csam_instance):
+    with pytest.raises(ValueError):
+        csam_instance._parse_query({"100": 0.5})
+    assert csam_instance.attend({"100": 0.5}, [], MagicMock()).as_dict() == {}
 
-    chunk3 = csr_matrix([[0, 0, 0]])
-    similarity_zero = csam_instance._calculate_similarity(chunk1, chunk3)
-    assert similarity_zero == 0.0
+def test_parsed_query_is_cached(csam_instance):
+    indices, values, magnitude = csam_instance._parsed_query({"3": 3.0, "4": 4.0})
+    assert magnitude == pytest.approx(5.0)
+    assert not indices.flags.writeable and not values.flags.writeable
+    assert csam_instance._parsed_query({"4": 4.0, "3": 3.0})[0] is indices
+    assert csam_instance._parsed_query({"3": 3.0, "4": 1.0})[0] is not indices
+
+def test_magnitude(csam_instance):
+    assert csam_instance._magnitude(np.array([3.0, 4.0])) == pytest.approx(5.0)
+    assert csam_instance._magnitude(np.array([])) == 0.0
+
+def test_accumulate_kernel():
+    q_ind = np.array([0, 2], dtype=np.int32)
+    q_val = np.array([1.0, 2.0])
+    references = csr_matrix([[1.0, 5.0, 0.0], [0.0, 0.0, 3.0], [0.0, 7.0, 0.0]])
+    out_sum = np.zeros(2)
+    accumulate(q_ind, q_val, np.sqrt(5), references.data, references.indices, references.indptr,
+               np.array([0, 0, 1]), out_sum)
+    # cos(q, q * r) for r = [1, 5, 0] is 1/sqrt(5), for r = [0, 0, 3] it is 2/sqrt(5), and 0 without overlap
+    assert out_sum[0] == pytest.approx(3 / np.sqrt(5))
+    assert out_sum[1] == 0.0
+
+@pytest.mark.parametrize("query_nnz", [3, 60])
+def test_reference_similarities_matches_dense(query_nnz):
+    rng = np.random.default_rng(0)
+    references = rng.random((20, 100)) * (rng.random((20, 100)) < 0.7)
+    q_ind = np.sort(rng.choice(100, size=query_nnz, replace=False)).astype(np.int32)
+    q_val = rng.random(query_nnz)
+    q_dense = np.zeros(100)
+    q_dense[q_ind] = q_val
+    sparse_references = csr_matrix(references)
+    out = np.empty(20)
+    reference_similarities(q_ind, q_val, np.linalg.norm(q_val), sparse_references.data,
+                           sparse_references.indices, sparse_references.indptr, out)
+    scaled = references * q_dense
+    norms = np.linalg.norm(scaled, axis=1)
+    expected = np.divide(scaled @ q_dense, norms * np.linalg.norm(q_dense), out=np.zeros(20), where=norms > 0)
+    assert out == pytest.approx(expected)
+
+def test_similarity_totals_simsimd_matches_kernel(csam_instance, monkeypatch):
+    pytest.importorskip("simsimd")
+    rng = np.random.default_rng(1)
+    hkg_nodes = [(f"node{i}", {'sanm_references': [rng.standard_normal(100) * (rng.random(100) < 0.3) for _ in range(i % 3 + 1)], 'layer': 0})
+                 for i in range(20)]
+    hkg_nodes.append(("zero", {'sanm_references': [np.zeros(100)], 'layer': 0}))
+    query_chunk = {str(i): rng.standard_normal() for i in rng.choice(100, 15, replace=False)}
+    with_simsimd = csam_instance.attend(query_chunk, hkg_nodes, MagicMock())
+    monkeypatch.setattr(csam, "simsimd", None)
+    with_kernel = csam_instance.attend(query_chunk, hkg_nodes, MagicMock())
+    assert with_simsimd.scores == pytest.approx(with_kernel.scores, abs=1e-5)
+    assert with_simsimd.as_dict()["zero"] == 0.0
+
+def test_combine_scores_kernel():
+    out = np.empty(4)
+    layer_table = np.array([1.0, 2.0, 1.0], dtype=np.float32)
+    combine_scores(np.array([1.0, 1.0, 3.0, 2.0]), np.array([2, 1, 3, 1]), np.array([0, 1, 2, 7]), layer_table,
+                   np.array([1.0, 1.0, 1.0, 0.0]), np.array([0.0, 2.0, 1.0, 0.0]), 0.5, 0.25, 1, out)
+    # Layer 0: 0.5 * 1.0; layer 1: 1.0 * 2.0 + 2 edges; layers 2 and 7 read the padding and add keyword + edge
+    assert out.tolist() == pytest.approx([0.5, 2.5, 1.75, 2.0])
+
+def test_attend_follows_changed_weights(csam_instance):
+    hkg_nodes = [("node1", {'sanm_references': [1], 'layer': 2, 'data': {'description': 'A cat'}})]
+    graph = MagicMock()
+    graph.out_edges.return_value = []
+    assert csam_instance.attend({"1": 0.5, "cat": 1.0}, hkg_nodes, graph).as_dict() == pytest.approx({"node1": 1.4 + 0.2})
+    csam_instance.keyword_importance = 0.5
+    assert csam_instance.attend({"1": 0.5, "cat": 1.0}, hkg_nodes, graph).as_dict() == pytest.approx({"node1": 1.4 + 0.5})
+
+def test_layer_table_follows_layer_importance(csam_instance):
+    assert csam_instance._layer_table.tolist()[:5] == pytest.approx([1, 1.2, 1.4, 1.6, 1])
+    assert csam_instance._layer_table.dtype == np.float32
+    csam_instance.layer_importance = [2.0]
+    hkg_nodes = [("node1", {'sanm_references': [1], 'layer': 0}), ("node2", {'sanm_references': [1], 'layer': 300})]
+    attention_scores = csam_instance.attend({"1": 0.5}, hkg_nodes, MagicMock()).as_dict()
+    assert attention_scores == pytest.approx({"node1": 2.0, "node2": 1.0})
 
 def test_attend_basic(csam_instance, caplog):
     query_chunk = {"10": 0.7, "20": 0.9}
@@ -49,9 +119,13 @@ def test_attend_basic(csam_instance, caplog):
         ("node2", {"sanm_references": [np.array([0.9] * 100)], 'layer': 1})
     ]
     mock_graph = MagicMock()
-    attention_scores = csam_instance.attend(query_chunk, hkg_nodes, mock_graph)
+    attention_scores = csam_instance.attend(query_chunk, hkg_nodes, mock_graph).as_dict()
     assert "node1" in attention_scores
     assert "node2" in attention_scores
+    assert "Attention Score" not in caplog.text
+    with caplog.at_level(logging.DEBUG, logger="csam"):
+        csam_instance.attend(query_chunk, hkg_nodes, mock_graph)
+    assert "Node: node2, Similarity: 1.00, Layer: 1, Keyword Matches: 0, Edge Matches: 0, Attention Score: 1.20" in caplog.text
 
 def test_attend_with_keyword_boost(csam_instance):
     csam_instance.keyword_importance = 0.5
@@ -60,9 +134,21 @@ def test_attend_with_keyword_boost(csam_instance):
         ("node1", {"sanm_references": [np.array([0.5] * 100)], 'layer': 2, 'data': {'description': 'This node contains 1'}}),
     ]
     mock_graph = MagicMock()
-    attention_scores = csam_instance.attend(query_chunk, hkg_nodes, mock_graph)
+    attention_scores = csam_instance.attend(query_chunk, hkg_nodes, mock_graph).as_dict()
     assert attention_scores["node1"] > 0  # Ensure keyword boost increases score
 
+def test_attend_keyword_matches_whole_tokens(csam_instance):
+    csam_instance.keyword_importance = 0.5
+    query_chunk = {"1": 0.8}
+    hkg_nodes = [
+        ("node1", {"sanm_references": [1], 'layer': 2, 'data': {'description': 'Lives 12-15 years'}}),
+        ("node2", {"sanm_references": [1], 'layer': 2, 'data': {'description': 'ignored'},
+                   'data_tokens': {'description': frozenset({'1'})}}),
+    ]
+    attention_scores = csam_instance.attend(query_chunk, hkg_nodes, MagicMock()).as_dict()
+    assert attention_scores["node1"] == pytest.approx(1.4)
+    assert attention_scores["node2"] == pytest.approx(1.4 + 0.5)
+
 def test_attend_with_edge_boost(csam_instance):
     csam_instance.edge_importance = 0.3
     csam_instance.min_layer_edge_context = 0
@@ -72,14 +158,70 @@ def test_attend_with_edge_boost(csam_instance):
         ("node2", {"sanm_references": [np.array([0.6] * 100)], 'layer': 1, 'data': {'description': 'This is 1'}}),
     ]
     mock_graph = MagicMock()
-    mock_graph.edges.return_value = [("node2", "node1", None, {'relation': 'is_a'})]
-    mock_graph.nodes = {"node1": {'data': {'description': 'parent description'}}} # Mock node data access
-    attention_scores = csam_instance.attend(query_chunk, hkg_nodes, mock_graph)
+    mock_graph.out_edges.return_value = [("node2", "node1", None, {'relation': 'is_a'})]
+    mock_graph.nodes = {"node1": {'data': {'description': 'parent description 1'}}} # Mock node data access
+    attention_scores = csam_instance.attend(query_chunk, hkg_nodes, mock_graph).as_dict()
     assert attention_scores.get("node2", 0) > 0 # Ensure edge boost increases score
+    assert attention_scores["node2"] == pytest.approx(1.2 + 0.3)
+    mock_graph.out_edges.assert_any_call("node2", keys=True, data=True)
+
+def test_attend_skips_references_without_shared_features(csam_instance):
+    query_chunk = {"1": 0.5, "2": 0.5}
+    overlapping = np.zeros(100)
+    overlapping[1] = 0.4
+    disjoint = np.zeros(100)
+    disjoint[50] = 0.9
+    hkg_nodes = [("node1", {'sanm_references': [overlapping, disjoint], 'layer': 0})]
+    mock_graph = MagicMock()
+    attention_scores = csam_instance.attend(query_chunk, hkg_nodes, mock_graph).as_dict()
+    # cos(q, q * overlapping) = 1/sqrt(2); the disjoint reference averages in as 0
+    assert attention_scores["node1"] == pytest.approx(0.5 / np.sqrt(2))
+    assert csam_instance._ref_matrix[:, 50].nnz == 1
+    assert csam_instance.attend(query_chunk, hkg_nodes, mock_graph).as_dict() == attention_scores
+
+def test_attend_returns_arrays_aligned_with_nodes(csam_instance):
+    hkg_nodes = [("node1", {'sanm_references': [], 'layer': 0}), ("node2", {'sanm_references': [1], 'layer': 1})]
+    result = csam_instance.attend({"1": 0.5}, hkg_nodes, MagicMock())
+    assert isinstance(result, AttentionResult)
+    assert result.node_ids.tolist() == ["node1", "node2"]
+    assert result.scores.dtype == np.float32
+    assert result.scores.tolist() == pytest.approx([0.0, 1.2])
+
+def test_attend_node_ids_are_read_only(csam_instance):
+    hkg_nodes = [("b", {'sanm_references': [1], 'layer': 0}), ("a", {'sanm_references': [], 'layer': 0})]
+    graph = MagicMock()
+    result = csam_instance.attend({"1": 0.5}, hkg_nodes, graph)
+    with pytest.raises(ValueError):
+        result.node_ids.sort()
+    assert csam_instance.attend({"1": 0.5}, hkg_nodes, graph).as_dict() == {"b": 1.0, "a": 0.0}
 
 def test_attend_no_sanm_references(csam_instance):
     query_chunk = {"1": 0.5}
     hkg_nodes = [("node1", {'sanm_references': [], 'layer': 0})]
     mock_graph = MagicMock()
-    attention_scores = csam_instance.attend(query_chunk, hkg_nodes, mock_graph)
-    assert attention_scores["node1"] == 0
\ No newline at end of file
+    attention_scores = csam_instance.attend(query_chunk, hkg_nodes, mock_graph).as_dict()
+    assert attention_scores["node1"] == 0
+
+def test_attend_rebuilds_index_after_hkg_changes(csam_instance):
+    from hkg_ag import HKG_AG
+    hkg = HKG_AG()
+    hkg_nodes = hkg.nodes_snapshot()
+    query_chunk = {"1": 0.9, "3": 0.7}
+    before = csam_instance.attend(query_chunk, hkg_nodes, hkg.graph).as_dict()
+    assert csam_instance.attend(query_chunk, hkg_nodes, hkg.graph).as_dict() == before
+    indexed_layers = csam_instance._layers
+
+    # The same list is passed again, but the graph version tells the index is stale
+    hkg.update_node_layer("dog", 3)
+    after = csam_instance.attend(query_chunk, hkg_nodes, hkg.graph).as_dict()
+    assert csam_instance._layers is not indexed_layers
+    assert after["dog"] == pytest.approx(before["dog"] / 1.2 * 1.6)
+
+def test_attend_reuses_index_for_untracked_changes(csam_instance):
+    hkg_nodes = [("node1", {'sanm_references': [1], 'layer': 0})]
+    graph = MagicMock()
+    assert csam_instance.attend({"1": 0.5}, hkg_nodes, graph).as_dict() == {"node1": 1.0}
+    # Editing the list in place is not detected; a new list is needed
+    hkg_nodes[0][1]['layer'] = 1
+    assert csam_instance.attend({"1": 0.5}, hkg_nodes, graph).as_dict() == {"node1": 1.0}
+    assert csam_instance.attend({"1": 0.5}, list(hkg_nodes), graph).as_dict() == pytest.approx({"node1": 1.2})
@@ -0,0 +1,47 @@
+import pytest
+from hkg_ag import HKG_AG
+
+@pytest.fixture
+def hkg_instance():
+    return HKG_AG()
+
+def test_nodes_snapshot_reused_until_change(hkg_instance):
+    snapshot = hkg_instance.nodes_snapshot()
+    assert isinstance(snapshot, tuple)
+    assert snapshot == tuple(hkg_instance.graph.nodes(data=True))
+    assert hkg_instance.nodes_snapshot() is snapshot
+    # Reads do not invalidate it
+    hkg_instance.get_node("cat")
+    hkg_instance.get_nodes_in_layer(1)
+    assert hkg_instance.nodes_snapshot() is snapshot
+
+@pytest.mark.parametrize("mutate", [
+    lambda hkg: hkg.add_node("wolf", "Wolf", 1, [4]),
+    lambda hkg: hkg.add_edge("cat", "dog", "related_to"),
+    lambda hkg: hkg.update_node_layer("cat", 2),
+    lambda hkg: hkg.update_node_data("cat", {"description": "A small cat"}),
+    lambda hkg: hkg.update_edge_data("cat", "animal", 0, {"weight": 1}),
+    lambda hkg: hkg.merge_nodes(["cat", "dog", "lion"], "animals", "Animals", 3),
+])
+def test_nodes_snapshot_rebuilt_after_change(hkg_instance, mutate):
+    snapshot = hkg_instance.nodes_snapshot()
+    version = hkg_instance.graph.graph['version']
+    mutate(hkg_instance)
+    rebuilt = hkg_instance.nodes_snapshot()
+    assert rebuilt is not snapshot
+    assert rebuilt == tuple(hkg_instance.graph.nodes(data=True))
+    assert hkg_instance.graph.graph['version'] > version
+    assert hkg_instance.nodes_snapshot() is rebuilt
+
+def test_nodes_snapshot_drops_merged_nodes(hkg_instance):
+    hkg_instance.nodes_snapshot()
+    hkg_instance.merge_nodes(["cat", "dog", "lion"], "animals", "Animals", 3)
+    node_ids = [node_id for node_id, _ in hkg_instance.nodes_snapshot()]
+    assert "animals" in node_ids
+    assert not {"cat", "dog", "lion"} & set(node_ids)
+
+def test_failed_mutation_keeps_snapshot(hkg_instance):
+    snapshot = hkg_instance.nodes_snapshot()
+    hkg_instance.add_node("cat", "Cat", 1, [1])  # Already exists
+    hkg_instance.update_node_layer("missing", 2)
+    assert hkg_instance.nodes_snapshot() is snapshot
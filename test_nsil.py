@@ -2,6 +2,7 @@ import pytest
 from nsil import NSIL
 from unittest.mock import MagicMock
 import numpy as np
+import logging
 from scipy.sparse import csr_matrix
 
 @pytest.fixture
@@ -25,12 +26,24 @@ def test_dict_to_sparse_invalid_keys_nsil(nsil_instance, caplog):
     assert "Skipping non-integer feature key: 'invalid'" in caplog.text
     assert "Skipping non-integer feature key: 'also_invalid'" in caplog.text
 
-def test_array_to_sparse_nsil(nsil_instance):
-    array = [0, 1, 0, 2, 0]
-    sparse_matrix = nsil_instance._array_to_sparse(array)
-    assert sparse_matrix.shape == (1, len(array))
-    assert sparse_matrix[0, 1] == 1
-    assert sparse_matrix[0, 3] == 2
+def test_dict_to_sparse_sums_duplicates_and_checks_range_nsil(nsil_instance):
+    sparse_matrix = nsil_instance._dict_to_sparse({"3": 0.5, "01": 0.25, "1": 0.5})
+    assert sparse_matrix.indices.tolist() == [1, 3]
+    assert sparse_matrix.data.tolist() == [0.75, 0.5]
+    with pytest.raises(ValueError):
+        nsil_instance._dict_to_sparse({"100": 0.5})
+
+def test_ranked_nodes_matches_full_sort(nsil_instance):
+    attention_scores = {f"node{i}": float(i % 7) for i in range(100)}
+    expected = sorted(attention_scores.items(), key=lambda item: item[1], reverse=True)
+    assert list(nsil_instance._ranked_nodes(attention_scores)) == expected
+
+def test_rule_map_follows_rules(nsil_instance):
+    assert [rule["target_attributes"] for rule in nsil_instance._rule_map["is_a"]] == [["description"]]
+    nsil_instance.rules = [{"if_relation": "part_of", "then_boost": False, "target_attributes": ["name"]},
+                           {"if_relation": "part_of", "then_boost": True, "target_attributes": ["location"]}]
+    assert list(nsil_instance._rule_map) == ["part_of"]
+    assert len(nsil_instance._rule_map["part_of"]) == 2
 
 def test_integrate_basic(nsil_instance):
     query_chunk = {"1": 0.9, "3": 0.7}
@@ -38,29 +51,93 @@ def test_integrate_basic(nsil_instance):
     mock_sanm = MagicMock()
     mock_hkg = MagicMock()
     mock_hkg.get_node.return_value = {'sanm_references': [np.array([0.1] * 100)]}
-    mock_hkg.graph.edges.return_value = []  # No rules applied in this basic test
+    mock_hkg.graph.out_edges.return_value = []  # No rules applied in this basic test
 
     combined_vector, updated_attention = nsil_instance.integrate(query_chunk, attention_scores, mock_sanm, mock_hkg)
 
     assert isinstance(combined_vector, csr_matrix)
     assert updated_attention == attention_scores  # Basic test, no rules to change scores
 
-def test_integrate_rule_boost(nsil_instance):
+def test_integrate_combines_references(nsil_instance):
+    query_chunk = {"1": 0.9, "3": 0.7}
+    attention_scores = {"node1": 0.8, "node2": 0.6}
+    mock_hkg = MagicMock()
+    mock_hkg.get_node.return_value = {'sanm_references': [np.array([0.5] * 100), 2]}
+    mock_hkg.graph.out_edges.return_value = []
+
+    combined_vector, _ = nsil_instance.integrate(query_chunk, attention_scores, MagicMock(), mock_hkg)
+
+    # Two top nodes, each contributing query * 0.5 + query * 2
+    assert combined_vector.indices.tolist() == [1, 3]
+    assert combined_vector.data.tolist() == pytest.approx([4.5, 3.5])
+    assert combined_vector.dtype == np.float32
+
+def test_integrate_reuses_reference_sums_until_hkg_changes(nsil_instance):
+    node_data = {'sanm_references': [np.full(100, 1.0)]}
+    mock_hkg = MagicMock()
+    mock_hkg.graph.graph = {'version': 0}
+    mock_hkg.get_node.return_value = node_data
+    mock_hkg.graph.out_edges.return_value = []
+
+    combined_vector, _ = nsil_instance.integrate({"1": 0.5}, {"node1": 0.8}, MagicMock(), mock_hkg)
+    assert combined_vector.data.tolist() == pytest.approx([0.5])
+    reference_sum = nsil_instance._reference_sums["node1"]
+    assert reference_sum.dtype == np.float32
+
+    # Editing the references in place is not detected, as in CSAM
+    node_data['sanm_references'].append(2)
+    node_data['sanm_references'][0][1] = 4.0
+    combined_vector, _ = nsil_instance.integrate({"1": 0.5}, {"node1": 0.8}, MagicMock(), mock_hkg)
+    assert combined_vector.data.tolist() == pytest.approx([0.5])
+    assert nsil_instance._reference_sums["node1"] is reference_sum
+
+    # A new graph version drops the cached sums
+    mock_hkg.graph.graph['version'] += 1
+    combined_vector, _ = nsil_instance.integrate({"1": 0.5}, {"node1": 0.8}, MagicMock(), mock_hkg)
+    assert combined_vector.indices.tolist() == [1]
+    assert combined_vector.data.tolist() == pytest.approx([3.0])
+
+def test_integrate_rule_boost(nsil_instance, caplog):
     nsil_instance.rule_importance = 0.5
     query_chunk = {"1": 1.0}
     attention_scores = {"top_node": 0.5, "node2": 0.7}
     mock_sanm = MagicMock()
     mock_hkg = MagicMock()
-    mock_hkg.get_node.side_effect = [
-        {'sanm_references': [np.array([0.1] * 100)]},  # For top node
-        {'data': {'description': 'This node contains 1'}}, # For target node of the rule
-    ]
-    mock_hkg.graph.edges.return_value = [("top_node", "node2", None, {'relation': 'is_a'})]
+    nodes = {
+        "top_node": {'sanm_references': [np.array([0.1] * 100)]},  # For top node
+        "node2": {'data': {'description': 'This node contains 1'}}, # For target node of the rule
+    }
+    mock_hkg.get_node.side_effect = nodes.get
+    mock_hkg.graph.out_edges.return_value = [("top_node", "node2", 0, {'relation': 'is_a'})]
 
-    combined_vector, updated_attention = nsil_instance.integrate(query_chunk, attention_scores, mock_sanm, mock_hkg)
+    with caplog.at_level(logging.DEBUG, logger="nsil"):
+        combined_vector, updated_attention = nsil_instance.integrate(query_chunk, attention_scores, mock_sanm, mock_hkg)
 
     assert updated_attention["node2"] > 0.7 # Score should be boosted
+    assert "Rule applied, boosting node: 'node2' due to node: 'top_node' having a 'is_a' relation, new score: 1.20" in caplog.text
+    assert attention_scores["node2"] == 0.7 # The input scores are left unchanged
+    mock_hkg.graph.out_edges.assert_called_once_with("top_node", keys=True, data=True)
+    # Each node is fetched from the HKG once
+    assert sorted(call.args[0] for call in mock_hkg.get_node.call_args_list) == ["node2", "top_node"]
     
+def test_integrate_rule_matches_whole_tokens(nsil_instance):
+    nsil_instance.rule_importance = 0.5
+    attention_scores = {"top_node": 0.5, "node2": 0.7, "node3": 0.1}
+    mock_hkg = MagicMock()
+    nodes = {
+        "top_node": {'sanm_references': [1]},
+        "node2": {'data': {'description': 'Lives 12-15 years'}},
+        "node3": {'data': {'description': 'ignored'}, 'data_tokens': {'description': frozenset({'1', 'years'})}},
+    }
+    mock_hkg.get_node.side_effect = nodes.get
+    mock_hkg.graph.out_edges.return_value = [("top_node", "node2", 0, {'relation': 'is_a'}), ("top_node", "node3", 0, {'relation': 'is_a'})]
+
+    _, updated_attention = nsil_instance.integrate({"1": 1.0, "YEARS": 1.0}, attention_scores, MagicMock(), mock_hkg)
+
+    # "1" is not a token of "12-15"; precomputed data_tokens are used when present
+    assert updated_attention["node2"] == pytest.approx(1.2)
+    assert updated_attention["node3"] == pytest.approx(1.1)
+
 def test_integrate_no_top_nodes(nsil_instance):
     query_chunk = {"1": 0.9, "3": 0.7}
     attention_scores = {"node1": 0.8, "node2": 0.6}
@@ -71,4 +148,13 @@ def test_integrate_no_top_nodes(nsil_instance):
     combined_vector, updated_attention = nsil_instance.integrate(query_chunk, attention_scores, mock_sanm, mock_hkg)
 
     assert combined_vector.nnz == 0 # No SANM references to combine
-    assert updated_attention == attention_scores
\ No newline at end of file
+    assert updated_attention == attention_scores
+
+def test_integrate_no_top_nodes_skips_query_parsing(nsil_instance):
+    mock_hkg = MagicMock()
+    mock_hkg.get_node.return_value = None
+
+    combined_vector, updated_attention = nsil_instance.integrate({"100": 0.9}, {"node1": 0.8}, MagicMock(), mock_hkg)
+
+    assert combined_vector.nnz == 0
+    assert updated_attention == {"node1": 0.8}
@@ -0,0 +1,135 @@
+import pytest
+from sanm import SANM
+from sanm_kernel import sparse_cosine
+import numpy as np
+from scipy.sparse import csr_matrix
+
+@pytest.fixture
+def index_path(tmp_path):
+    return str(tmp_path / "sanm_index.ann")
+
+@pytest.fixture
+def sanm_instance(index_path):
+    return SANM(feature_dimension=10, similarity_threshold=0.6, num_trees=10, index_path=index_path)
+
+def dense_cosine(a, b):
+    magnitude = np.linalg.norm(a) * np.linalg.norm(b)
+    return float(np.dot(a, b) / magnitude) if magnitude else 0.0
+
+@pytest.mark.parametrize("a, b", [
+    ([1.0, 0, 2.0, 0, 0, 3.0], [0.5, 0, -1.0, 0, 0, 4.0]),  # Same support
+    ([1.0, 2.0, 0, 0, 0, 0], [0, 0, 0, 3.0, 4.0, 0]),  # Disjoint indices
+    ([1.0, 0, 0, 0, 2.0, 5.0], [3.0, 0, 0, 0, 0, 0]),  # First vector has the longer tail
+    ([0, 1.0, 0, 0, 0, 0], [0, 2.0, 1.0, 0, 7.0, 1.0]),  # Second vector has the longer tail
+    ([0, 0, 0, 0, 0, 0], [1.0, 0, 0, 0, 0, 0]),  # Zero vector
+    ([0, 0, 0, 0, 0, 0], [0, 0, 0, 0, 0, 0]),
+])
+def test_sparse_cosine_matches_dense(a, b):
+    sparse_a, sparse_b = csr_matrix(np.array([a])), csr_matrix(np.array([b]))
+    similarity = sparse_cosine(sparse_a.data, sparse_a.indices, sparse_b.data, sparse_b.indices)
+    assert similarity == pytest.approx(dense_cosine(np.array(a), np.array(b)))
+    assert sparse_cosine(sparse_b.data, sparse_b.indices, sparse_a.data, sparse_a.indices) == pytest.approx(similarity)
+
+def test_sparse_cosine_matches_dense_random():
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        a = rng.standard_normal(40) * (rng.random(40) < 0.3)
+        b = rng.standard_normal(40) * (rng.random(40) < 0.3)
+        sparse_a, sparse_b = csr_matrix(a), csr_matrix(b)
+        assert sparse_cosine(sparse_a.data, sparse_a.indices, sparse_b.data, sparse_b.indices) == pytest.approx(dense_cosine(a, b))
+
+def test_calculate_similarity_sums_duplicates(sanm_instance):
+    chunk1 = csr_matrix((np.array([1.0, 1.0]), np.array([2, 2]), np.array([0, 2])), shape=(1, 10))
+    chunk2 = sanm_instance._dict_to_sparse({"2": 1.0, "3": 1.0})
+    assert sanm_instance._calculate_similarity(chunk1, chunk2) == pytest.approx(1 / np.sqrt(2))
+
+def test_save_index_keeps_loaded_index_file(sanm_instance, index_path):
+    sanm_instance.add({"1": 1.0, "2": 1.0})
+    sanm_instance.save_index()
+    with open(index_path, "rb") as index_file:
+        saved = index_file.read()
+
+    loaded = SANM(feature_dimension=10, similarity_threshold=0.6, index_path=index_path)
+    assert loaded.index_loaded
+    loaded.add({"1": 1.0, "2": 1.0})
+    loaded.save_index()
+    with open(index_path, "rb") as index_file:
+        assert index_file.read() == saved
+    # The rebuilt in-memory index still serves queries
+    assert len(loaded.query({"1": 1.0})) == 1
+
+    loaded.add({"1": 1.0})
+    loaded.save_index(overwrite=True)
+    with open(index_path, "rb") as index_file:
+        assert index_file.read() != saved
+
+def test_add_marks_index_dirty_until_saved(sanm_instance):
+    assert not sanm_instance._index_dirty
+    sanm_instance.add({"1": 1.0})
+    assert sanm_instance._index_dirty
+    sanm_instance.save_index()
+    assert not sanm_instance._index_dirty and sanm_instance._index_built
+    sanm_instance.add({"1": 0.5})  # Merged into the first chunk
+    assert sanm_instance._index_dirty
+
+def test_query_rejects_unbuilt_or_dirty_index(sanm_instance, capsys):
+    sanm_instance.add({"1": 1.0})
+    assert sanm_instance.query({"1": 1.0}) == []
+    sanm_instance.save_index()
+    assert len(sanm_instance.query({"1": 1.0})) == 1
+    sanm_instance.add({"5": 1.0})
+    assert sanm_instance.query({"1": 1.0}) == []
+    assert "call save_index before querying" in capsys.readouterr().out
+
+def test_annoy_ids_map_to_memory_rows(sanm_instance, index_path):
+    sanm_instance.add({"1": 1.0})
+    sanm_instance.add({"5": 1.0})
+    sanm_instance.add({"1": 0.9, "2": 0.1})  # Merged into row 0
+    sanm_instance.add({"8": 1.0})
+    assert sanm_instance._annoy_to_mem_idx == {0: 0, 1: 1, 2: 2}
+    assert [mem_annoy for _, mem_annoy in sanm_instance.memory] == [0, 1, 2]
+    sanm_instance.save_index()
+
+    loaded = SANM(feature_dimension=10, index_path=index_path)
+    assert loaded._annoy_to_mem_idx == {0: 0, 1: 1, 2: 2}
+    assert loaded.annoy_index_count == 3
+
+def test_add_after_build_uses_annoy_candidates(sanm_instance, monkeypatch):
+    for feature in range(8):
+        sanm_instance.add({str(feature): 1.0})
+    sanm_instance._normalized_memory()
+    sanm_instance.save_index()
+    assert sanm_instance._memory_matrix is None
+    sanm_instance.add({"9": 1.0})  # Not in the built index yet
+
+    calls = []
+    annoy_neighbors = sanm_instance._annoy_neighbors
+    def spy(sparse_vector, count):
+        calls.append(count)
+        return annoy_neighbors(sparse_vector, count)
+    monkeypatch.setattr(sanm_instance, "_annoy_neighbors", spy)
+    monkeypatch.setattr(sanm_instance, "_normalized_memory", lambda: pytest.fail("linear scan used"))
+
+    sanm_instance.add({"3": 1.0, "4": 0.1})
+    assert calls == [5]
+    assert sanm_instance.memory[3][0].toarray()[0, 3] == pytest.approx(2.0)
+    # Rows added since the build are compared exactly
+    sanm_instance.add({"9": 0.5})
+    assert len(sanm_instance.memory) == 9
+    assert sanm_instance.memory[8][0].toarray()[0, 9] == pytest.approx(1.5)
+    # The normalized stack is not kept up to date once the index is built
+    assert sanm_instance._memory_matrix is None
+
+def test_save_load_round_trip_angular(sanm_instance, index_path):
+    sanm_instance.add({"1": 3.0, "2": 4.0})
+    sanm_instance.add({"7": 2.0})
+    sanm_instance.save_index()
+
+    loaded = SANM(feature_dimension=10, similarity_threshold=0.6, index_path=index_path)
+    # Angular indexes keep the raw vectors, so magnitudes survive the round trip
+    assert loaded.memory[0][0].toarray().ravel().tolist() == pytest.approx([0, 3.0, 4.0, 0, 0, 0, 0, 0, 0, 0])
+    assert loaded.memory[1][0].toarray().ravel().tolist() == pytest.approx([0, 0, 0, 0, 0, 0, 0, 2.0, 0, 0])
+    ids, distances = loaded._annoy_neighbors(loaded._dict_to_sparse({"1": 0.3, "2": 0.4}), 2)
+    assert ids[0] == 0 and distances[0] == pytest.approx(0.0, abs=1e-3)
+    results = loaded.query({"7": 5.0})
+    assert len(results) == 1 and results[0][1] == pytest.approx(1.0)